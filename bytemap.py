@@ -1,7 +1,14 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+import numpy as np
+import functools
+import io
+import math
 import os
+import queue
+import struct
 import zstandard as zstd
 import logging
 import threading
@@ -9,57 +16,208 @@ import threading
 # Configure error logging
 logging.basicConfig(filename='error.log', level=logging.ERROR)
 
-def compress_data(data):
+# zstd dictionary trained on small text and source files; the dictionary ID
+# is stored with each image so decoding can pick the matching one
+DICTIONARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bytemap.dict')
+
+def load_dictionary(path=DICTIONARY_PATH):
+    try:
+        with open(path, 'rb') as f:
+            return zstd.ZstdCompressionDict(f.read())
+    except OSError:
+        return None
+
+DICTIONARY = load_dictionary()
+
+def get_dictionary(dict_id):
+    if dict_id == 0:
+        return None
+    if DICTIONARY is None or DICTIONARY.dict_id() != dict_id:
+        raise ValueError(f"Compression dictionary {dict_id} is not available.")
+    return DICTIONARY
+
+# zstd contexts own sizeable working buffers, so they are built once per
+# dictionary and reused. Each conversion runs on a fresh thread, which
+# rules out thread-local caching; a lock serialises use instead.
+_compressors = {}
+_decompressors = {}
+_compressor_lock = threading.Lock()
+_decompressor_lock = threading.Lock()
+
+def get_compressor(dictionary=None):
+    key = dictionary.dict_id() if dictionary else 0
+    if key not in _compressors:
+        _compressors[key] = zstd.ZstdCompressor(dict_data=dictionary, threads=-1)
+    return _compressors[key]
+
+def get_decompressor(dictionary=None):
+    key = dictionary.dict_id() if dictionary else 0
+    if key not in _decompressors:
+        _decompressors[key] = zstd.ZstdDecompressor(dict_data=dictionary)
+    return _decompressors[key]
+
+READ_CHUNK_SIZE = 4 << 20
+READ_AHEAD_CHUNKS = 4
+
+def read_chunks(path, chunks, stop):
+    # Runs on its own thread so disk reads overlap with compression.
+    # None marks the end of the file; an exception is handed on as-is.
+    # Gives up once stop is set, so a failed compression never leaves
+    # it blocked on a full queue.
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
     try:
-        cctx = zstd.ZstdCompressor()
-        compressed_data = cctx.compress(data)
-        return compressed_data
+        with open(path, "rb") as src:
+            while True:
+                chunk = src.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if not put(chunk):
+                    return
+        put(None)
+    except Exception as e:
+        put(e)
+
+def compress_file(path, dictionary=None, progress=None):
+    try:
+        total_size = os.path.getsize(path)
+        done_size = 0
+        buf = io.BytesIO()
+        # Feed the file through in chunks so it is never held in memory whole
+        chunks = queue.Queue(maxsize=READ_AHEAD_CHUNKS)
+        stop = threading.Event()
+        reader = threading.Thread(target=read_chunks, args=(path, chunks, stop), daemon=True)
+        reader.start()
+        try:
+            with _compressor_lock:
+                cctx = get_compressor(dictionary)
+                try:
+                    with cctx.stream_writer(buf, size=total_size, closefd=False) as writer:
+                        while True:
+                            chunk = chunks.get()
+                            if chunk is None:
+                                break
+                            if isinstance(chunk, Exception):
+                                raise chunk
+                            writer.write(chunk)
+                            # Report as the input is consumed, not just once compression ends
+                            done_size += len(chunk)
+                            if progress:
+                                progress(done_size, total_size)
+                except Exception:
+                    # A threaded context that failed mid-frame crashes the
+                    # interpreter if reused, so drop it and build a new one next time
+                    _compressors.pop(dictionary.dict_id() if dictionary else 0, None)
+                    raise
+        finally:
+            # Release the reader even if compression failed part way
+            stop.set()
+            while True:
+                try:
+                    chunks.get_nowait()
+                except queue.Empty:
+                    break
+            reader.join()
+        return buf.getbuffer()
     except Exception as e:
         logging.error("Error during compression: %s", e)
         raise
 
-def decompress_data(data):
+def decompress_data(data, dictionary=None):
     try:
-        dctx = zstd.ZstdDecompressor()
-        decompressed_data = dctx.decompress(data)
+        with _decompressor_lock:
+            dctx = get_decompressor(dictionary)
+            # Stream a single frame so trailing pixel padding is left unread
+            dobj = dctx.decompressobj()
+            decompressed_data = dobj.decompress(data)
+        if not dobj.eof:
+            raise ValueError("Compressed data is truncated: the zstd frame is incomplete.")
+        content_size = zstd.frame_content_size(data)
+        if content_size != zstd.CONTENTSIZE_UNKNOWN and len(decompressed_data) != content_size:
+            raise ValueError("Decompressed size does not match the size recorded in the zstd frame.")
         return decompressed_data
     except Exception as e:
         logging.error("Error during decompression: %s", e)
         raise
 
-def binary_to_rgba_pixels(binary_data):
-    padding_length = (32 - len(binary_data) % 32) % 32
-    binary_data += '0' * padding_length
-    pixels = []
-
-    for i in range(0, len(binary_data), 32):
-        chunk = binary_data[i:i+32]
-        r = int(chunk[0:8], 2)
-        g = int(chunk[8:16], 2)
-        b = int(chunk[16:24], 2)
-        a = int(chunk[24:32], 2)
-        pixels.append((r, g, b, a))
-
-    return pixels, padding_length
-
-def rgba_pixels_to_binary(pixels):
-    binary_data = []
-    for pixel in pixels:
-        r, g, b, a = pixel
-        binary_data.append(f'{r:08b}{g:08b}{b:08b}{a:08b}')
-    binary_data = ''.join(binary_data)
-    return binary_data
-
-def create_image_from_binary(binary_data, width, height):
-    pixels, _ = binary_to_rgba_pixels(binary_data)
-    img = Image.new('RGBA', (width, height))
-    img.putdata(pixels)
-    return img
-
-def create_binary_from_image(img):
-    pixels = list(img.getdata())
-    binary_data = rgba_pixels_to_binary(pixels)
-    return binary_data
+# Image widths are kept to a multiple of this so libpng can use its
+# vectorised row filters
+ROW_ALIGN = 16
+
+@functools.lru_cache(maxsize=32)
+def image_size(pixel_count):
+    # Smallest aligned square that fits, then look for a near-square
+    # rectangle with an aligned width that wastes fewer pixels
+    side = math.isqrt(pixel_count)
+    if side * side < pixel_count:
+        side += 1
+    side = (side + ROW_ALIGN - 1) & ~(ROW_ALIGN - 1)
+    best_width, best_height = side, (pixel_count + side - 1) // side
+    for width in range(side, max(side * 3 // 4, ROW_ALIGN) - 1, -ROW_ALIGN):
+        height = (pixel_count + width - 1) // width
+        if width * height < best_width * best_height:
+            best_width, best_height = width, height
+            if width * height == pixel_count:
+                break
+    return best_width, best_height
+
+def create_image_from_bytes(data, width, height):
+    # The bytes are the grayscale pixels once zero-padded to fill the image
+    buf = np.frombuffer(data, dtype=np.uint8)
+    pad = width * height - len(data)
+    padded = np.pad(buf, (0, pad), 'constant')
+    img = Image.frombuffer('L', (width, height), padded, 'raw', 'L', 0, 1)
+    return img, pad
+
+def create_bytes_from_image(img):
+    # Images written with metadata know their payload length; older ones
+    # keep the zero padding, which zstd ignores past the end of the frame
+    compressed_size = getattr(img, 'text', {}).get('compressed_size')
+    # Grayscale images hold one byte per pixel, older RGBA images four
+    mode = 'L' if img.mode == 'L' else 'RGBA'
+    if img.mode != mode:
+        img = img.convert(mode)
+    # Flat view of the pixels; trimming slices it without copying
+    byte_data = np.asarray(img, dtype=np.uint8).reshape(-1)
+    if compressed_size is not None:
+        byte_data = byte_data[:int(compressed_size)]
+    return byte_data
+
+# Raw container: magic, format version, original size, compressed size,
+# dictionary ID, then the zstd frame. Avoids a second, useless deflate
+# pass over already-compressed data.
+RAW_MAGIC = b'BYTM'
+RAW_VERSION = 1
+RAW_HEADER = struct.Struct('<4sHQQI')
+
+def save_raw(output_file, compressed_data, original_size, dict_id):
+    with open(output_file, "wb") as f:
+        f.write(RAW_HEADER.pack(RAW_MAGIC, RAW_VERSION, original_size, len(compressed_data), dict_id))
+        f.write(compressed_data)
+
+def is_raw_file(path):
+    with open(path, "rb") as f:
+        return f.read(len(RAW_MAGIC)) == RAW_MAGIC
+
+def load_raw(path):
+    with open(path, "rb") as f:
+        header = f.read(RAW_HEADER.size)
+        if len(header) < RAW_HEADER.size:
+            raise ValueError("File is too short to be a ByteMap file.")
+        magic, version, original_size, compressed_size, dict_id = RAW_HEADER.unpack(header)
+        if magic != RAW_MAGIC or version != RAW_VERSION:
+            raise ValueError(f"Unsupported ByteMap file version: {version}")
+        compressed_data = f.read(compressed_size)
+    if len(compressed_data) != compressed_size:
+        raise ValueError("ByteMap file is truncated.")
+    return compressed_data, original_size, dict_id
 
 class ByteMapApp:
     def __init__(self, root):
@@ -84,17 +242,21 @@ class ByteMapApp:
         self.output_location_button = tk.Button(root, text="Browse", command=self.select_output_location)
         self.output_location_button.grid(row=1, column=2, padx=10, pady=10)
 
+        self.save_png_var = tk.BooleanVar(value=False)
+        self.save_png_checkbox = tk.Checkbutton(root, text="Save as viewable PNG image", variable=self.save_png_var)
+        self.save_png_checkbox.grid(row=2, column=1, padx=10, pady=10)
+
         self.progress_bar = ttk.Progressbar(root, orient='horizontal', length=400, mode='determinate')
-        self.progress_bar.grid(row=2, column=1, padx=10, pady=10)
+        self.progress_bar.grid(row=3, column=1, padx=10, pady=10)
 
         self.convert_to_image_button = tk.Button(root, text="Convert File to Image", command=self.start_file_to_image_thread)
-        self.convert_to_image_button.grid(row=3, column=1, padx=10, pady=10)
+        self.convert_to_image_button.grid(row=4, column=1, padx=10, pady=10)
 
         self.convert_to_file_button = tk.Button(root, text="Convert Image to File", command=self.start_image_to_file_thread)
-        self.convert_to_file_button.grid(row=4, column=1, padx=10, pady=10)
+        self.convert_to_file_button.grid(row=5, column=1, padx=10, pady=10)
 
         self.status_label = tk.Label(root, text="", fg="green")
-        self.status_label.grid(row=5, column=1, padx=10, pady=10)
+        self.status_label.grid(row=6, column=1, padx=10, pady=10)
 
     def select_input_file(self):
         file_path = filedialog.askopenfilename(title="Select a File")
@@ -109,16 +271,18 @@ class ByteMapApp:
             self.output_location_entry.insert(0, directory)
 
     def update_progress(self, value):
-        self.progress_bar['value'] = value
-        self.root.update_idletasks()
+        # Called from worker threads; Tk is not thread-safe, so hand the
+        # update to the main loop
+        self.root.after(0, lambda v=value: self.progress_bar.configure(value=v))
 
     def start_file_to_image_thread(self):
-        threading.Thread(target=self.convert_file_to_image).start()
+        # Read Tk state here on the main thread, not in the worker
+        threading.Thread(target=self.convert_file_to_image, args=(self.save_png_var.get(),)).start()
 
     def start_image_to_file_thread(self):
         threading.Thread(target=self.convert_image_to_file).start()
 
-    def convert_file_to_image(self):
+    def convert_file_to_image(self, save_png=False):
         input_file = self.input_file_entry.get()
         output_dir = self.output_location_entry.get()
         if not input_file or not output_dir:
@@ -128,44 +292,49 @@ class ByteMapApp:
         try:
             self.update_progress(0)
             
-            # Read the original file data
-            with open(input_file, "rb") as f:
-                file_data = f.read()
-
-            original_size = len(file_data)
+            original_size = os.path.getsize(input_file)
             self.update_progress(20)
             
-            # Compress the data
-            compressed_data = compress_data(file_data)
+            # Compress the file data
+            compressed_data = compress_file(input_file, DICTIONARY,
+                                            lambda done, total: self.update_progress(20 + 30 * done // total))
             compressed_size = len(compressed_data)
+            dict_id = DICTIONARY.dict_id() if DICTIONARY else 0
 
             # Check if the compressed data is smaller than the original
             if compressed_size >= original_size:
                 messagebox.showinfo("Info", "Compressed file is not smaller than the original. No file saved.")
                 return
 
-            # Convert compressed data to binary
-            binary_data = ''.join(format(byte, '08b') for byte in compressed_data)
-
             self.update_progress(50)
-            pixel_count = (len(binary_data) + 31) // 32
-            width = height = int(pixel_count ** 0.5) + 1
+            base_filename = os.path.splitext(os.path.basename(input_file))[0]
 
-            # Create image from binary data
-            img = create_image_from_binary(binary_data, width, height)
+            if save_png:
+                pixel_count = compressed_size
+                width, height = image_size(pixel_count)
 
-            # Save the image
-            base_filename = os.path.basename(input_file)
-            output_filename = os.path.splitext(base_filename)[0] + ".bytemap.png"
-            output_file = os.path.join(output_dir, output_filename)
-            img.save(output_file)
+                # Create image from the compressed bytes
+                img, pad = create_image_from_bytes(compressed_data, width, height)
+
+                # Record the payload length so decoding can drop the padding
+                metadata = PngInfo()
+                metadata.add_text("pad", str(pad))
+                metadata.add_text("compressed_size", str(compressed_size))
+                metadata.add_text("dict_id", str(dict_id))
+
+                # Save the image
+                output_file = os.path.join(output_dir, base_filename + ".bytemap.png")
+                img.save(output_file, pnginfo=metadata, optimize=False, compress_level=1)
+            else:
+                output_file = os.path.join(output_dir, base_filename + ".bytemap")
+                save_raw(output_file, compressed_data, original_size, dict_id)
 
             # Calculate compression efficiency
             compression_ratio = compressed_size / original_size
             compression_percentage = (1 - compression_ratio) * 100
 
             self.update_progress(100)
-            self.status_label.config(text=f"File converted to image successfully: {output_file}\n"
+            self.status_label.config(text=f"File converted successfully: {output_file}\n"
                                           f"Original Size: {original_size} bytes\n"
                                           f"Compressed Size: {compressed_size} bytes\n"
                                           f"Compression Efficiency: {compression_percentage:.2f}%")
@@ -183,17 +352,23 @@ class ByteMapApp:
         try:
             self.update_progress(0)
             
-            # Open the image
-            img = Image.open(input_file)
+            if is_raw_file(input_file):
+                byte_data, original_size, dict_id = load_raw(input_file)
+            else:
+                # Open the image
+                img = Image.open(input_file)
 
-            # Convert image to binary data
-            binary_data = create_binary_from_image(img)
+                # Read the compressed bytes back out of the pixels
+                byte_data = create_bytes_from_image(img)
+                original_size = None
+                dict_id = int(getattr(img, 'text', {}).get('dict_id', 0))
 
             self.update_progress(50)
-            byte_data = int(binary_data, 2).to_bytes((len(binary_data) + 7) // 8, byteorder='big')
 
             # Decompress the data
-            decompressed_data = decompress_data(byte_data)
+            decompressed_data = decompress_data(byte_data, get_dictionary(dict_id))
+            if original_size is not None and len(decompressed_data) != original_size:
+                raise ValueError("Decompressed size does not match the original file size.")
 
             # Write the decompressed data to file
             base_filename = os.path.basename(input_file)
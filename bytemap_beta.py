@@ -2,75 +2,223 @@ import sys
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QLabel, QLineEdit, QPushButton, 
                             QProgressBar, QFileDialog, QMessageBox, QFrame,
-                            QStatusBar)
+                            QStatusBar, QCheckBox)
 from PyQt6.QtCore import Qt, QThread, pyqtSignal
 from PyQt6.QtGui import QFont, QIcon
 from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+import numpy as np
+import functools
+import io
+import math
 import os
+import queue
+import struct
+import threading
 import zstandard as zstd
 import logging
 
 # Configure error logging
 logging.basicConfig(filename='error.log', level=logging.ERROR)
 
+# zstd dictionary trained on small text and source files
+DICTIONARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bytemap.dict')
+
+def load_dictionary(path=DICTIONARY_PATH):
+    try:
+        with open(path, 'rb') as f:
+            return zstd.ZstdCompressionDict(f.read())
+    except OSError:
+        return None
+
+DICTIONARY = load_dictionary()
+
+# Raw container: magic, format version, original size, compressed size,
+# dictionary ID, then the zstd frame
+RAW_MAGIC = b'BYTM'
+RAW_VERSION = 1
+RAW_HEADER = struct.Struct('<4sHQQI')
+
+# Image widths are kept to a multiple of this for libpng's row filters
+ROW_ALIGN = 16
+
+READ_CHUNK_SIZE = 4 << 20
+READ_AHEAD_CHUNKS = 4
+
+# zstd contexts are reused across workers, one per dictionary; every worker
+# is a new thread, so access is serialised with a lock
+_compressors = {}
+_decompressors = {}
+_compressor_lock = threading.Lock()
+_decompressor_lock = threading.Lock()
+
 class ConversionWorker(QThread):
     progress = pyqtSignal(int)
     finished = pyqtSignal(str, bool)
     error = pyqtSignal(str)
 
-    def __init__(self, mode, input_file, output_dir):
+    def __init__(self, mode, input_file, output_dir, save_png=False):
         super().__init__()
         self.mode = mode
         self.input_file = input_file
         self.output_dir = output_dir
+        self.save_png = save_png
+
+    def get_dictionary(self, dict_id):
+        if dict_id == 0:
+            return None
+        if DICTIONARY is None or DICTIONARY.dict_id() != dict_id:
+            raise ValueError(f"Compression dictionary {dict_id} is not available.")
+        return DICTIONARY
+
+    def get_compressor(self, dictionary=None):
+        key = dictionary.dict_id() if dictionary else 0
+        if key not in _compressors:
+            _compressors[key] = zstd.ZstdCompressor(dict_data=dictionary, threads=-1)
+        return _compressors[key]
+
+    def get_decompressor(self, dictionary=None):
+        key = dictionary.dict_id() if dictionary else 0
+        if key not in _decompressors:
+            _decompressors[key] = zstd.ZstdDecompressor(dict_data=dictionary)
+        return _decompressors[key]
+
+    def read_chunks(self, path, chunks, stop):
+        # Reader thread: overlaps disk reads with compression and gives up
+        # once stop is set
+        def put(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            with open(path, "rb") as src:
+                while True:
+                    chunk = src.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if not put(chunk):
+                        return
+            put(None)
+        except Exception as e:
+            put(e)
 
-    def compress_data(self, data):
+    def compress_file(self, path, dictionary=None, progress=None):
         try:
-            cctx = zstd.ZstdCompressor()
-            return cctx.compress(data)
+            total_size = os.path.getsize(path)
+            done_size = 0
+            buf = io.BytesIO()
+            chunks = queue.Queue(maxsize=READ_AHEAD_CHUNKS)
+            stop = threading.Event()
+            reader = threading.Thread(target=self.read_chunks, args=(path, chunks, stop), daemon=True)
+            reader.start()
+            try:
+                with _compressor_lock:
+                    cctx = self.get_compressor(dictionary)
+                    try:
+                        with cctx.stream_writer(buf, size=total_size, closefd=False) as writer:
+                            while True:
+                                chunk = chunks.get()
+                                if chunk is None:
+                                    break
+                                if isinstance(chunk, Exception):
+                                    raise chunk
+                                writer.write(chunk)
+                                done_size += len(chunk)
+                                if progress:
+                                    progress(done_size, total_size)
+                    except Exception:
+                        _compressors.pop(dictionary.dict_id() if dictionary else 0, None)
+                        raise
+            finally:
+                stop.set()
+                while True:
+                    try:
+                        chunks.get_nowait()
+                    except queue.Empty:
+                        break
+                reader.join()
+            return buf.getbuffer()
         except Exception as e:
             logging.error(f"Compression error: {e}")
             raise
 
-    def decompress_data(self, data):
+    def decompress_data(self, data, dictionary=None):
         try:
-            dctx = zstd.ZstdDecompressor()
-            return dctx.decompress(data)
+            with _decompressor_lock:
+                dctx = self.get_decompressor(dictionary)
+                dobj = dctx.decompressobj()
+                decompressed_data = dobj.decompress(data)
+            if not dobj.eof:
+                raise ValueError("Compressed data is truncated: the zstd frame is incomplete.")
+            content_size = zstd.frame_content_size(data)
+            if content_size != zstd.CONTENTSIZE_UNKNOWN and len(decompressed_data) != content_size:
+                raise ValueError("Decompressed size does not match the size recorded in the zstd frame.")
+            return decompressed_data
         except Exception as e:
             logging.error(f"Decompression error: {e}")
             raise
 
-    def binary_to_rgba_pixels(self, binary_data):
-        padding_length = (32 - len(binary_data) % 32) % 32
-        binary_data += '0' * padding_length
-        pixels = []
-
-        for i in range(0, len(binary_data), 32):
-            chunk = binary_data[i:i+32]
-            r = int(chunk[0:8], 2)
-            g = int(chunk[8:16], 2)
-            b = int(chunk[16:24], 2)
-            a = int(chunk[24:32], 2)
-            pixels.append((r, g, b, a))
-
-        return pixels, padding_length
-
-    def rgba_pixels_to_binary(self, pixels):
-        binary_data = []
-        for pixel in pixels:
-            r, g, b, a = pixel
-            binary_data.append(f'{r:08b}{g:08b}{b:08b}{a:08b}')
-        return ''.join(binary_data)
-
-    def create_image_from_binary(self, binary_data, width, height):
-        pixels, _ = self.binary_to_rgba_pixels(binary_data)
-        img = Image.new('RGBA', (width, height))
-        img.putdata(pixels)
-        return img
-
-    def create_binary_from_image(self, img):
-        pixels = list(img.getdata())
-        return self.rgba_pixels_to_binary(pixels)
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def image_size(pixel_count):
+        side = math.isqrt(pixel_count)
+        if side * side < pixel_count:
+            side += 1
+        side = (side + ROW_ALIGN - 1) & ~(ROW_ALIGN - 1)
+        best_width, best_height = side, (pixel_count + side - 1) // side
+        for width in range(side, max(side * 3 // 4, ROW_ALIGN) - 1, -ROW_ALIGN):
+            height = (pixel_count + width - 1) // width
+            if width * height < best_width * best_height:
+                best_width, best_height = width, height
+                if width * height == pixel_count:
+                    break
+        return best_width, best_height
+
+    def create_image_from_bytes(self, data, width, height):
+        buf = np.frombuffer(data, dtype=np.uint8)
+        pad = width * height - len(data)
+        padded = np.pad(buf, (0, pad), 'constant')
+        img = Image.frombuffer('L', (width, height), padded, 'raw', 'L', 0, 1)
+        return img, pad
+
+    def create_bytes_from_image(self, img):
+        compressed_size = getattr(img, 'text', {}).get('compressed_size')
+        # Grayscale images hold one byte per pixel, older RGBA images four
+        mode = 'L' if img.mode == 'L' else 'RGBA'
+        if img.mode != mode:
+            img = img.convert(mode)
+        # Flat view of the pixels; trimming slices it without copying
+        byte_data = np.asarray(img, dtype=np.uint8).reshape(-1)
+        if compressed_size is not None:
+            byte_data = byte_data[:int(compressed_size)]
+        return byte_data
+
+    def save_raw(self, output_file, compressed_data, original_size, dict_id):
+        with open(output_file, "wb") as f:
+            f.write(RAW_HEADER.pack(RAW_MAGIC, RAW_VERSION, original_size, len(compressed_data), dict_id))
+            f.write(compressed_data)
+
+    def is_raw_file(self, path):
+        with open(path, "rb") as f:
+            return f.read(len(RAW_MAGIC)) == RAW_MAGIC
+
+    def load_raw(self, path):
+        with open(path, "rb") as f:
+            header = f.read(RAW_HEADER.size)
+            if len(header) < RAW_HEADER.size:
+                raise ValueError("File is too short to be a ByteMap file.")
+            magic, version, original_size, compressed_size, dict_id = RAW_HEADER.unpack(header)
+            if magic != RAW_MAGIC or version != RAW_VERSION:
+                raise ValueError(f"Unsupported ByteMap file version: {version}")
+            compressed_data = f.read(compressed_size)
+        if len(compressed_data) != compressed_size:
+            raise ValueError("ByteMap file is truncated.")
+        return compressed_data, original_size, dict_id
 
     def run(self):
         try:
@@ -85,31 +233,38 @@ class ConversionWorker(QThread):
         try:
             self.progress.emit(10)
             
-            with open(self.input_file, "rb") as f:
-                file_data = f.read()
-
-            original_size = len(file_data)
+            original_size = os.path.getsize(self.input_file)
             self.progress.emit(30)
             
-            compressed_data = self.compress_data(file_data)
+            compressed_data = self.compress_file(self.input_file, DICTIONARY,
+                                                 lambda done, total: self.progress.emit(30 + 30 * done // total))
             compressed_size = len(compressed_data)
+            dict_id = DICTIONARY.dict_id() if DICTIONARY else 0
 
             if compressed_size >= original_size:
                 self.error.emit("Compressed file is not smaller than the original.")
                 return
 
-            binary_data = ''.join(format(byte, '08b') for byte in compressed_data)
             self.progress.emit(60)
 
-            pixel_count = (len(binary_data) + 31) // 32
-            width = height = int(pixel_count ** 0.5) + 1
+            base_filename = os.path.splitext(os.path.basename(self.input_file))[0]
 
-            img = self.create_image_from_binary(binary_data, width, height)
+            if self.save_png:
+                pixel_count = compressed_size
+                width, height = self.image_size(pixel_count)
 
-            base_filename = os.path.basename(self.input_file)
-            output_filename = os.path.splitext(base_filename)[0] + ".bytemap.png"
-            output_file = os.path.join(self.output_dir, output_filename)
-            img.save(output_file)
+                img, pad = self.create_image_from_bytes(compressed_data, width, height)
+
+                metadata = PngInfo()
+                metadata.add_text("pad", str(pad))
+                metadata.add_text("compressed_size", str(compressed_size))
+                metadata.add_text("dict_id", str(dict_id))
+
+                output_file = os.path.join(self.output_dir, base_filename + ".bytemap.png")
+                img.save(output_file, pnginfo=metadata, optimize=False, compress_level=1)
+            else:
+                output_file = os.path.join(self.output_dir, base_filename + ".bytemap")
+                self.save_raw(output_file, compressed_data, original_size, dict_id)
 
             compression_ratio = compressed_size / original_size
             compression_percentage = (1 - compression_ratio) * 100
@@ -130,16 +285,21 @@ class ConversionWorker(QThread):
         try:
             self.progress.emit(10)
             
-            img = Image.open(self.input_file)
-            self.progress.emit(30)
-
-            binary_data = self.create_binary_from_image(img)
-            self.progress.emit(50)
+            if self.is_raw_file(self.input_file):
+                byte_data, original_size, dict_id = self.load_raw(self.input_file)
+                self.progress.emit(30)
+            else:
+                img = Image.open(self.input_file)
+                self.progress.emit(30)
 
-            byte_data = int(binary_data, 2).to_bytes((len(binary_data) + 7) // 8, byteorder='big')
+                byte_data = self.create_bytes_from_image(img)
+                original_size = None
+                dict_id = int(getattr(img, 'text', {}).get('dict_id', 0))
             self.progress.emit(70)
 
-            decompressed_data = self.decompress_data(byte_data)
+            decompressed_data = self.decompress_data(byte_data, self.get_dictionary(dict_id))
+            if original_size is not None and len(decompressed_data) != original_size:
+                raise ValueError("Decompressed size does not match the original file size.")
 
             base_filename = os.path.basename(self.input_file)
             output_filename = os.path.splitext(base_filename)[0] + ".output"
@@ -217,6 +377,10 @@ class ByteMapQt(QMainWindow):
         main_layout.addWidget(self.input_frame)
         main_layout.addWidget(self.output_frame)
 
+        # Add output format option
+        self.save_png_checkbox = QCheckBox("Save as viewable PNG image")
+        main_layout.addWidget(self.save_png_checkbox)
+
         # Add progress bar
         self.progress_bar = QProgressBar()
         self.progress_bar.setTextVisible(True)
@@ -278,7 +442,8 @@ class ByteMapQt(QMainWindow):
             QMessageBox.warning(self, "Error", "Output directory does not exist.")
             return
 
-        self.worker = ConversionWorker(mode, input_path, output_dir)
+        self.worker = ConversionWorker(mode, input_path, output_dir,
+                                       self.save_png_checkbox.isChecked())
         self.worker.progress.connect(self.update_progress)
         self.worker.finished.connect(self.conversion_finished)
         self.worker.error.connect(self.show_error)
@@ -305,6 +470,7 @@ class ByteMapQt(QMainWindow):
         self.to_file_button.setEnabled(enabled)
         self.input_frame.setEnabled(enabled)
         self.output_frame.setEnabled(enabled)
+        self.save_png_checkbox.setEnabled(enabled)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)